@@ -1,8 +1,12 @@
 import os
+import re
+from collections import deque
+from dataclasses import dataclass, fields
 from datetime import datetime
-import json
 import altair as alt
 import google.generativeai as genai
+import numpy as np
+import orjson
 import pandas as pd
 import streamlit as st
 
@@ -43,10 +47,66 @@ Constraints:
 - For pie/donut, 'x' is the category and 'y' is the numeric value.
 """
 
+# Most recent chat messages (user and assistant) kept for display
+CHAT_HISTORY_LIMIT = 20
+
+# First flat {...} in the model reply, skipping any prose or code fences around it
+_JSON_RE = re.compile(rb"\{[^{}]*\}", re.S)
+
+@dataclass(slots=True)
+class ChartSpec:
+    chart_type: str = "bar"
+    x: str = "Category"
+    y: str = "Sales"
+    color: str | None = None
+    aggregate: str = "sum"
+
+    @classmethod
+    def from_json(cls, data: dict) -> "ChartSpec":
+        # Unknown keys are ignored; null or empty values fall back to the defaults
+        return cls(**{k: data[k] for k in _CHART_SPEC_FIELDS if data.get(k)})
+
+_CHART_SPEC_FIELDS = tuple(f.name for f in fields(ChartSpec))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def gemini_chart_spec(query: str) -> dict:
+    # Cached across reruns (unlike functools.lru_cache, which the script rerun would rebuild),
+    # so repeating a chart description skips the Gemini round trip; failures are not cached.
+    # Returns the raw dict: script-defined classes like ChartSpec can't be pickled by the cache.
+    prompt = f"{CHART_SYSTEM_PROMPT}\nUser request: {query}"
+    resp = model.generate_content(prompt)
+    match = _JSON_RE.search(resp.text.encode())
+    if match is None:
+        raise ValueError("no JSON object in response")
+    return orjson.loads(match.group(0))
+
 # ---------- LOAD DATA ----------
-@st.cache_data
+# Only the columns the dashboard, chart builder and chat context read; IDs and product names are dropped
+USED_COLS = [
+    "Order ID", "Order Date", "Ship Date", "Ship Mode", "Customer Name", "Segment", "Country", "City",
+    "State", "Region", "Category", "Sub-Category", "Sales", "Quantity", "Discount", "Profit",
+]
+
+# cache_resource hands every caller the same read-only frame instead of unpickling a copy per call
+@st.cache_resource
 def load_data(path: str):
-    df_local = pd.read_excel(path, sheet_name="Orders")
+    # Parsing the workbook dominates cold starts, so keep a typed Parquet snapshot next to it.
+    # The snapshot is rebuilt whenever the workbook or this loader changes.
+    parquet_path = os.path.splitext(path)[0] + ".parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= max(
+        os.path.getmtime(path), os.path.getmtime(__file__)
+    ):
+        try:
+            return pd.read_parquet(parquet_path, columns=USED_COLS)
+        except Exception:
+            # Unreadable snapshot: reparse the workbook below, which also overwrites it
+            pass
+
+    try:
+        df_local = pd.read_excel(path, sheet_name="Orders", usecols=USED_COLS, engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine missing or pandas too old for it: fall back to openpyxl
+        df_local = pd.read_excel(path, sheet_name="Orders", usecols=USED_COLS)
     df_local["Order Date"] = pd.to_datetime(df_local["Order Date"])
     df_local["Ship Date"] = pd.to_datetime(df_local["Ship Date"])
     
@@ -54,10 +114,92 @@ def load_data(path: str):
     numeric_cols = ["Sales", "Profit", "Quantity", "Discount"]
     for col in numeric_cols:
         df_local[col] = pd.to_numeric(df_local[col], errors='coerce').fillna(0)
+
+    # Low-cardinality dimensions as categoricals: filters compare int codes, groupbys skip string hashing
+    category_cols = ["Region", "Segment", "Category", "Sub-Category", "Ship Mode"]
+    for col in category_cols:
+        df_local[col] = df_local[col].astype("category")
+    # Order ID is only ever counted; its integer codes make nunique hash ints instead of strings
+    df_local["Order ID"] = df_local["Order ID"].astype("category")
+
+    # Write aside and swap in with os.replace so a crash mid-write never leaves a truncated snapshot
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    try:
+        df_local.to_parquet(tmp_path, compression="zstd")
+        os.replace(tmp_path, parquet_path)
+    except Exception:
+        # Read-only checkout or no pyarrow: just parse the workbook again next cold start
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return df_local
 
+DATA_PATH = "sample_superstore.xlsx"
+
+# ---------- FILTERED VIEW ----------
+def filter_data(start, end, region: str, segment: str):
+    df_all = load_data(DATA_PATH)
+    # Build one composite numpy mask (no index alignment) and index the frame at most once
+    mask = np.ones(len(df_all), dtype=bool)
+    if start is not None and end is not None:
+        # Convert the picker dates straight to datetime64 scalars; no Timestamp round trip
+        start64, end64 = np.datetime64(start, "ns"), np.datetime64(end, "ns")
+        order_dates = df_all["Order Date"].values
+        mask &= (order_dates >= start64) & (order_dates <= end64)
+    if region != "All":
+        mask &= df_all["Region"].values == region
+    if segment != "All":
+        mask &= df_all["Segment"].values == segment
+    # Nothing filtered out: skip the boolean indexing and return the shared loaded frame (read-only)
+    return df_all if mask.all() else df_all[mask]
+
+@st.cache_data(show_spinner=False)
+def compute_view(start, end, region: str, segment: str):
+    # Memoized per filter combination, so reruns from unrelated widgets skip the scan entirely
+    view = filter_data(start, end, region, segment)
+    # One aggregation call for all four KPIs; nunique on the categorical Order ID works on its codes
+    kpis = view.agg({"Sales": "sum", "Profit": "sum", "Discount": "mean", "Order ID": "nunique"})
+    total_sales, total_profit, avg_discount = kpis["Sales"], kpis["Profit"], kpis["Discount"]
+    order_count = int(kpis["Order ID"])
+    # Aggregate server-side so Altair ships a handful of rows instead of the filtered frame
+    cat_agg = view.groupby("Category", as_index=False, observed=True)[["Sales", "Profit"]].sum()
+    reg_agg = view.groupby("Region", as_index=False, observed=True)[["Sales", "Profit"]].sum()
+    return total_sales, total_profit, avg_discount, order_count, cat_agg, reg_agg
+
+@st.cache_data(show_spinner=False)
+def chat_context(start, end, region: str, segment: str) -> str:
+    # Serialized once per filter combination instead of on every chat message
+    view = filter_data(start, end, region, segment)
+
+    # 1. Dynamic Dimension Discovery
+    exclude_cols = ['Order ID']
+    dimensions = [col for col in view.select_dtypes(include=['object', 'category']).columns if col not in exclude_cols]
+
+    full_context = ""
+    # 2. Build Categorical Summaries
+    for dim in dimensions:
+        summary = view.groupby(dim, observed=True)[['Sales', 'Profit']].sum().sort_values(by='Sales', ascending=False).head(10)
+        full_context += f"\n--- Top 10 by {dim} ---\n{summary.to_csv()}"
+
+    # 3. Build Time Summary (Top 10 dates)
+    time_summary = view.groupby('Order Date')[['Sales']].sum().sort_values(by='Sales', ascending=False).head(10)
+    full_context += f"\n--- Top 10 Sales Dates ---\n{time_summary.to_csv()}"
+    return full_context
+
+@st.cache_data(show_spinner=False)
+def get_unique_sorted(_df, col: str):
+    # _df is the immutable cached frame, so the column name alone is a sufficient cache key
+    return _df[col].cat.categories.tolist()
+
+@st.cache_data(show_spinner=False)
+def get_column_kinds(_df):
+    # Vega-Lite type per column (T/Q/N), derived once from the cached frame's dtypes
+    return {
+        c: "T" if pd.api.types.is_datetime64_any_dtype(_df[c]) else "Q" if pd.api.types.is_numeric_dtype(_df[c]) else "N"
+        for c in _df.columns
+    }
+
 try:
-    df = load_data("sample_superstore.xlsx")
+    df = load_data(DATA_PATH)
 except Exception as e:
     st.error(f"Excel file error: {e}")
     st.stop()
@@ -67,26 +209,22 @@ st.sidebar.header("Filters")
 min_date, max_date = df["Order Date"].min(), df["Order Date"].max()
 
 date_range = st.sidebar.date_input("Order Date range", [min_date, max_date], min_value=min_date, max_value=max_date)
-selected_region = st.sidebar.selectbox("Region", ["All"] + sorted(df["Region"].unique().tolist()))
-selected_segment = st.sidebar.selectbox("Segment", ["All"] + sorted(df["Segment"].unique().tolist()))
+selected_region = st.sidebar.selectbox("Region", ["All"] + get_unique_sorted(df, "Region"))
+selected_segment = st.sidebar.selectbox("Segment", ["All"] + get_unique_sorted(df, "Segment"))
 
-filtered = df.copy()
 if isinstance(date_range, (list, tuple)) and len(date_range) == 2:
     start, end = date_range
-    filtered = filtered[(filtered["Order Date"] >= pd.to_datetime(start)) & (filtered["Order Date"] <= pd.to_datetime(end))]
-
-if selected_region != "All":
-    filtered = filtered[filtered["Region"] == selected_region]
-if selected_segment != "All":
-    filtered = filtered[filtered["Segment"] == selected_segment]
+else:
+    start, end = None, None
 
 # ---------- KPIs ----------
 st.subheader("Key Metrics")
 k1, k2, k3, k4 = st.columns(4)
-k1.metric("Total Sales", f"${filtered['Sales'].sum():,.0f}")
-k2.metric("Total Profit", f"${filtered['Profit'].sum():,.0f}")
-k3.metric("Avg Discount", f"{filtered['Discount'].mean()*100:.1f}%")
-k4.metric("Order Count", f"{filtered['Order ID'].nunique():,}")
+total_sales, total_profit, avg_discount, order_count, cat_agg, reg_agg = compute_view(start, end, selected_region, selected_segment)
+k1.metric("Total Sales", f"${total_sales:,.0f}")
+k2.metric("Total Profit", f"${total_profit:,.0f}")
+k3.metric("Avg Discount", f"{avg_discount*100:.1f}%")
+k4.metric("Order Count", f"{order_count:,}")
 
 # ---------- STATIC VISUALS ----------
 st.markdown("---")
@@ -94,17 +232,17 @@ col_left, col_right = st.columns([2, 1])
 
 with col_left:
     st.markdown("### Sales by Category")
-    chart_cat = alt.Chart(filtered).mark_bar().encode(
+    chart_cat = alt.Chart(cat_agg).mark_bar().encode(
         x=alt.X("Category:N", sort="-y"),
-        y=alt.Y("sum(Sales):Q", title="Sales"),
+        y=alt.Y("Sales:Q", title="Sales"),
         color="Category:N"
     ).properties(height=300)
     st.altair_chart(chart_cat, use_container_width=True)
 
 with col_right:
     st.markdown("### Sales by Region")
-    chart_reg = alt.Chart(filtered).mark_bar().encode(
-        x=alt.X("sum(Sales):Q"),
+    chart_reg = alt.Chart(reg_agg).mark_bar().encode(
+        x=alt.X("Sales:Q"),
         y=alt.Y("Region:N", sort="-x"),
         color="Region:N"
     ).properties(height=300)
@@ -114,111 +252,122 @@ with col_right:
 st.markdown("---")
 st.markdown("## 🔧 AI Custom Chart Builder")
 
-if "ai_chart_spec" not in st.session_state:
-    st.session_state.ai_chart_spec = None
-if "last_query" not in st.session_state:
-    st.session_state.last_query = ""
-
-chart_query = st.text_input("Describe the chart (e.g., 'Donut chart of Profit by State')")
-create_btn = st.button("Create AI Chart")
-
-if create_btn and chart_query:
-    if not (GEMINI_API_KEY and model):
-        st.error("API Key missing.")
-    else:
-        with st.spinner("Gemini is analyzing..."):
-            try:
-                prompt = f"{CHART_SYSTEM_PROMPT}\nUser request: {chart_query}"
-                resp = model.generate_content(prompt)
-                raw = resp.text.strip()
-                s, e = raw.find("{"), raw.rfind("}")
-                st.session_state.ai_chart_spec = json.loads(raw[s : e + 1])
-                st.session_state.last_query = chart_query
-            except Exception as ex:
-                st.error(f"Error parsing Gemini response: {ex}")
-
-if st.session_state.ai_chart_spec:
-    spec = st.session_state.ai_chart_spec
-    try:
-        chart_type = spec.get("chart_type", "bar")
-        x_raw, y_raw = spec.get("x", "Category"), spec.get("y", "Sales")
-        agg = spec.get("aggregate") if spec.get("aggregate") else "sum"
-        
-        cols_map = {c.lower(): c for c in filtered.columns}
-        real_x = cols_map.get(x_raw.lower(), x_raw)
-        real_y = cols_map.get(y_raw.lower(), y_raw)
-
-        st.info(f"**Generated:** {st.session_state.last_query}")
-
-        if chart_type in ["pie", "donut"]:
-            # Aggregation is forced here to prevent the "barcode" effect
-            enc = {
-                "theta": alt.Theta(f"{agg}({real_y}):Q", title=f"{agg.capitalize()} of {real_y}"),
-                "color": alt.Color(f"{real_x}:N", title=real_x),
-                "tooltip": [real_x, alt.Tooltip(f"{agg}({real_y}):Q", format=",.0f")]
-            }
-            base = alt.Chart(filtered).mark_arc(innerRadius=80 if chart_type=="donut" else 0)
+# Fragment: typing a query or clicking the button reruns only this section, not the dashboard above
+@st.fragment
+def chart_builder(start, end, region: str, segment: str):
+    if "ai_chart_spec" not in st.session_state:
+        st.session_state.ai_chart_spec = None
+    if "last_query" not in st.session_state:
+        st.session_state.last_query = ""
+
+    chart_query = st.text_input("Describe the chart (e.g., 'Donut chart of Profit by State')")
+    create_btn = st.button("Create AI Chart")
+
+    if create_btn and chart_query:
+        if not (GEMINI_API_KEY and model):
+            st.error("API Key missing.")
         else:
-            enc = {
-                "x": alt.X(f"{real_x}:T") if "Date" in real_x else alt.X(f"{real_x}:N", sort='-y'),
-                "y": alt.Y(f"{agg}({real_y}):Q", title=f"{agg.capitalize()} of {real_y}"),
-                "tooltip": [real_x, alt.Tooltip(f"{agg}({real_y}):Q", format=",.0f")]
-            }
-            color_req = spec.get("color")
-            if color_req and color_req.lower() in cols_map:
-                enc["color"] = alt.Color(f"{cols_map[color_req.lower()]}:N")
+            with st.spinner("Gemini is analyzing..."):
+                try:
+                    st.session_state.ai_chart_spec = gemini_chart_spec(chart_query)
+                    st.session_state.last_query = chart_query
+                except Exception as ex:
+                    st.error(f"Error parsing Gemini response: {ex}")
+
+    if st.session_state.ai_chart_spec:
+        # Session state keeps the plain dict; the ChartSpec view is rebuilt from the current class on each run
+        spec = ChartSpec.from_json(st.session_state.ai_chart_spec)
+        # Only the rendered spec needs the filtered rows; query edits and clicks skip the filter
+        filtered = filter_data(start, end, region, segment)
+        try:
+            chart_type = spec.chart_type
+            x_raw, y_raw = spec.x, spec.y
+            agg = spec.aggregate
+        
+            cols_map = {c.lower(): c for c in filtered.columns}
+            real_x = cols_map.get(x_raw.lower(), x_raw)
+            real_y = cols_map.get(y_raw.lower(), y_raw)
+            x_kind = get_column_kinds(df).get(real_x, "N")
+
+            st.info(f"**Generated:** {st.session_state.last_query}")
+
+            color_col = None
+            if chart_type not in ["pie", "donut"] and spec.color and spec.color.lower() in cols_map:
+                color_col = cols_map[spec.color.lower()]
+
+            # Aggregate server-side so Vega-Lite receives one row per group instead of the filtered frame
+            group_cols = [real_x] if color_col in (None, real_x) else [real_x, color_col]
+            chart_data = filtered.groupby(group_cols, observed=True, as_index=False)[real_y].agg(agg)
+            y_title = f"{agg.capitalize()} of {real_y}"
+
+            if chart_type in ["pie", "donut"]:
+                # One slice per category, which also prevents the "barcode" effect
+                enc = {
+                    "theta": alt.Theta(f"{real_y}:Q", title=y_title),
+                    "color": alt.Color(f"{real_x}:N", title=real_x),
+                    "tooltip": [real_x, alt.Tooltip(f"{real_y}:Q", format=",.0f")]
+                }
+                base = alt.Chart(chart_data).mark_arc(innerRadius=80 if chart_type=="donut" else 0)
+            else:
+                enc = {
+                    "x": alt.X(f"{real_x}:{x_kind}", sort='-y') if x_kind == "N" else alt.X(f"{real_x}:{x_kind}"),
+                    "y": alt.Y(f"{real_y}:Q", title=y_title),
+                    "tooltip": [real_x, alt.Tooltip(f"{real_y}:Q", format=",.0f")]
+                }
+                if color_col:
+                    enc["color"] = alt.Color(f"{color_col}:N")
             
-            marks = {"line": alt.Chart(filtered).mark_line(point=True), 
-                     "scatter": alt.Chart(filtered).mark_point()}
-            base = marks.get(chart_type, alt.Chart(filtered).mark_bar())
+                marks = {"line": alt.Chart(chart_data).mark_line(point=True), 
+                         "scatter": alt.Chart(chart_data).mark_point()}
+                base = marks.get(chart_type, alt.Chart(chart_data).mark_bar())
+
+            st.altair_chart(base.encode(**enc).properties(height=450), use_container_width=True)
+        except Exception as render_err:
+            st.error(f"Render Error: {render_err}")
 
-        st.altair_chart(base.encode(**enc).properties(height=450), use_container_width=True)
-    except Exception as render_err:
-        st.error(f"Render Error: {render_err}")
+chart_builder(start, end, selected_region, selected_segment)
 
 # ---------- UNIVERSAL CHAT SECTION ----------
 st.markdown("---")
 st.subheader("Chat about the Dashboard")
 
-if GEMINI_API_KEY and model:
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+# Fragment: each chat turn reruns only this section, not the filters, KPIs and charts
+@st.fragment
+def chat_section(start, end, region: str, segment: str):
+    if GEMINI_API_KEY and model:
+        if "chat_history" not in st.session_state:
+            # Bounded so the per-rerun replay of past messages stays constant-size
+            st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_LIMIT)
 
-    for role, content in st.session_state.chat_history:
-        with st.chat_message(role):
-            st.markdown(content)
+        # Messages go in a container created before the input, so inside the fragment
+        # every turn (including the one being streamed) stays above the chat box
+        messages = st.container()
+        with messages:
+            for role, content in st.session_state.chat_history:
+                with st.chat_message(role):
+                    st.markdown(content)
 
-    user_q = st.chat_input("Ask anything (e.g., Which sub-category has highest profit? Which date had peak sales?)")
+        user_q = st.chat_input("Ask anything (e.g., Which sub-category has highest profit? Which date had peak sales?)")
     
-    if user_q:
-        st.session_state.chat_history.append(("user", user_q))
-        with st.chat_message("user"):
-            st.markdown(user_q)
-
-        # 1. Dynamic Dimension Discovery
-        exclude_cols = ['Row ID', 'Order ID', 'Customer ID', 'Product ID', 'Product Name']
-        dimensions = [col for col in filtered.select_dtypes(include=['object']).columns if col not in exclude_cols]
-
-        full_context = ""
-        # 2. Build Categorical Summaries
-        for dim in dimensions:
-            summary = filtered.groupby(dim)[['Sales', 'Profit']].sum().sort_values(by='Sales', ascending=False).head(10)
-            full_context += f"\n--- Top 10 by {dim} ---\n{summary.to_csv()}"
-
-        # 3. Build Time Summary (Top 10 dates)
-        time_summary = filtered.groupby('Order Date')[['Sales']].sum().sort_values(by='Sales', ascending=False).head(10)
-        full_context += f"\n--- Top 10 Sales Dates ---\n{time_summary.to_csv()}"
-
-        system_prompt = (
-            "You are an expert data analyst for a Superstore. I am providing you with multiple aggregated summaries "
-            "of the filtered data. Use these to answer the user's question with specific numbers.\n"
-            f"{full_context}"
-        )
+        if user_q:
+            st.session_state.chat_history.append(("user", user_q))
+            with messages, st.chat_message("user"):
+                st.markdown(user_q)
+
+            full_context = chat_context(start, end, region, segment)
+            system_prompt = (
+                "You are an expert data analyst for a Superstore. I am providing you with multiple aggregated summaries "
+                "of the filtered data. Use these to answer the user's question with specific numbers.\n"
+                f"{full_context}"
+            )
         
-        with st.chat_message("assistant"):
-            try:
-                chat_resp = model.generate_content(system_prompt + "\n\nUser Question: " + user_q)
-                st.markdown(chat_resp.text)
-                st.session_state.chat_history.append(("assistant", chat_resp.text))
-            except Exception as chat_err:
-                st.error(f"Chat error: {chat_err}")
+            with messages, st.chat_message("assistant"):
+                try:
+                    # Stream so the first tokens render while the rest of the answer is still generating
+                    chat_resp = model.generate_content(system_prompt + "\n\nUser Question: " + user_q, stream=True)
+                    answer = st.write_stream(chunk.text for chunk in chat_resp if chunk.parts)
+                    st.session_state.chat_history.append(("assistant", answer))
+                except Exception as chat_err:
+                    st.error(f"Chat error: {chat_err}")
+
+chat_section(start, end, selected_region, selected_segment)